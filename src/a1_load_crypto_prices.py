@@ -1,9 +1,62 @@
 import pandas as pd
 import numpy as np
-import ccxt
+import asyncio
+import hashlib
+import json
+import os
+import ccxt.async_support as ccxt_async
 import pytz
 from datetime import datetime, timezone, timedelta
-import time
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+def downcast_floats(df):
+    # store all float64 columns as float32
+    return df.astype({col: np.float32 for col in df.select_dtypes('float64').columns})
+
+def rolling_mean_std(values, windows):
+    """
+    Computes trailing rolling means and standard deviations for several window lengths from shared prefix sums.
+
+    Matches Series.rolling(w).mean() / .std(): NaN until the window is complete or if it contains NaN, std with ddof=1.
+
+    Args:
+        values (array-like): The values, in time order.
+        windows (list): The window lengths.
+
+    Returns:
+        dict: Maps each window length to a (mean, std) tuple of numpy arrays.
+    """
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    # the mean comes from the unshifted sums (zero volume stays exactly 0), the variance from sums shifted by
+    # the overall mean to limit cancellation in sum of squares minus squared sum
+    shift = values[valid].mean() if valid.any() else 0.0
+    x = np.where(valid, values - shift, 0.0)
+    csum = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    csum2 = np.concatenate([[0.0], np.cumsum(x * x)])
+    xsum = np.concatenate([[0.0], np.cumsum(x)])
+    ccount = np.concatenate([[0], np.cumsum(valid)])
+    # number of value changes up to each row, to find windows of identical values
+    cchange = np.concatenate([[0], np.cumsum(values[1:] != values[:-1])])
+
+    result = {}
+    for w in windows:
+        mean = np.full(values.size, np.nan)
+        std = np.full(values.size, np.nan)
+        if w <= values.size:
+            s = csum[w:] - csum[:-w]
+            xs = xsum[w:] - xsum[:-w]
+            s2 = csum2[w:] - csum2[:-w]
+            complete = (ccount[w:] - ccount[:-w]) == w
+            # windows of identical values: exactly that value as mean and 0 as std (like rolling)
+            constant = (cchange[w - 1:] - cchange[:values.size - w + 1]) == 0
+            mean[w - 1:] = np.where(complete, np.where(constant, values[w - 1:], s / w), np.nan)
+            if w > 1:
+                var = np.maximum(s2 - xs * xs / w, 0.0) / (w - 1)
+                std[w - 1:] = np.where(complete, np.where(constant, 0.0, np.sqrt(var)), np.nan)
+        result[w] = (mean, std)
+    return result
 
 class CryptoPriceLoader:
     """
@@ -13,14 +66,18 @@ class CryptoPriceLoader:
         symbols (list): A list of cryptocurrency symbols.
         timeframe (str): The timeframe for fetching the price data (default is '1h').
         days_ago (int): The number of days ago from which to start fetching the price data (default is 180).
+        cache_dir (str): Directory for the on-disk cache of OHLCV responses (default is None, in-memory cache only).
 
     Methods:
+        fetch_ohlcv_cached(symbol, since, limit): Fetches one page of OHLCV data, reusing cached pages of closed candles.
         fetch_all_ohlcv(symbol, limit): Fetches the OHLCV (Open, High, Low, Close, Volume) data for a specific symbol.
         prep_ohlcv_df(fetched_ohlcv, coin_name): Prepares the fetched OHLCV data as a DataFrame.
-        fetch_prepare_crypto_prices(): Fetches and prepares the cryptocurrency price data for all symbols.
+        fetch_prepare_crypto_prices(): Fetches and prepares the cryptocurrency price data for all symbols concurrently.
+        close(): Closes the exchange connection; the loader stays usable.
+        run(): Synchronous wrapper around fetch_prepare_crypto_prices() that closes the exchange afterwards.
     """
 
-    def __init__(self, symbols, timeframe='1h', days_ago=180):
+    def __init__(self, symbols, timeframe='1h', days_ago=180, cache_dir=None):
         """
         Initializes a CryptoPriceLoader object.
 
@@ -28,17 +85,81 @@ class CryptoPriceLoader:
             symbols (list): A list of cryptocurrency symbols.
             timeframe (str): The timeframe for fetching the price data (default is '1h').
             days_ago (int): The number of days ago from which to start fetching the price data (default is 180).
+            cache_dir (str): Directory for the on-disk cache of OHLCV responses (default is None, in-memory cache only).
         """
-        self.exchange = ccxt.coinbase()
+        self.exchange = self.create_exchange()
         self.symbols = symbols
         self.timeframe = timeframe
         self.now = self.exchange.milliseconds()
+        self.timeframe_ms = self.exchange.parse_timeframe(timeframe) * 1000
         self.first_retrieval_date = self.now - days_ago * 24 * 60 * 60 * 1000  # days_ago in milliseconds
+        self.cache_dir = cache_dir
+        self.ohlcv_cache = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
         self.berlin_tz = pytz.timezone('Europe/Berlin')
         self.now_dt = datetime.fromtimestamp(self.now / 1000, tz=timezone.utc).astimezone(self.berlin_tz)
         self.first_retrieval_date_dt = datetime.fromtimestamp(self.first_retrieval_date / 1000, tz=timezone.utc).astimezone(self.berlin_tz)
 
-    def fetch_all_ohlcv(self, symbol, limit=60):
+    def create_exchange(self):
+        # the exchange paces the concurrent requests itself (rate limit token bucket)
+        return ccxt_async.coinbase({'enableRateLimit': True})
+
+    async def close(self):
+        """
+        Closes the exchange connection and replaces it by a fresh instance, so the loader can be used again (also in a new event loop).
+        """
+        await self.exchange.close()
+        self.exchange = self.create_exchange()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def fetch_ohlcv_cached(self, symbol, since, limit):
+        """
+        Fetches one page of OHLCV data, cached in memory and (if cache_dir is set) on disk.
+
+        Only pages whose candles are all closed are cached; the newest page is always fetched from the exchange.
+
+        Args:
+            symbol (str): The cryptocurrency symbol.
+            since (int): The timestamp (ms) of the first candle.
+            limit (int): The maximum number of data points to fetch.
+
+        Returns:
+            list: A list of OHLCV data points.
+        """
+        key = f"{symbol}|{self.timeframe}|{since}|{limit}"
+        cacheable = since + (limit + 1) * self.timeframe_ms <= self.now
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+        if cacheable:
+            if key in self.ohlcv_cache:
+                return self.ohlcv_cache[key]
+            if path is not None and os.path.exists(path):
+                try:
+                    with open(path) as f:
+                        self.ohlcv_cache[key] = json.load(f)
+                    return self.ohlcv_cache[key]
+                except (OSError, ValueError):
+                    pass  # unreadable cache file: fetch again and overwrite it
+
+        ohlcv = await self.exchange.fetch_ohlcv(symbol, self.timeframe, since=since, limit=limit)
+        if cacheable:
+            self.ohlcv_cache[key] = ohlcv
+            if path is not None:
+                # write to a temporary file first, so an interrupted write never leaves a partial cache file
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(ohlcv, f)
+                os.replace(tmp_path, path)
+        return ohlcv
+
+    async def fetch_all_ohlcv(self, symbol, limit=60):
         """
         Fetches the OHLCV (Open, High, Low, Close, Volume) data for a specific symbol.
 
@@ -50,38 +171,48 @@ class CryptoPriceLoader:
             list: A list of OHLCV data points.
         """
         all_ohlcv = []
-        since = self.first_retrieval_date
+        # start on a fixed grid of pages so that the page requests (and cache keys) repeat across runs
+        since = self.first_retrieval_date - self.first_retrieval_date % (limit * self.timeframe_ms)
         while since < self.now:
-            ohlcv = self.exchange.fetch_ohlcv(symbol, self.timeframe, since=since, limit=limit)
+            ohlcv = await self.fetch_ohlcv_cached(symbol, since, limit)
             if not ohlcv:
-                since = since + limit * 60 * 60 * 1000  # Move to the next timestamp
+                since = since + limit * self.timeframe_ms  # Move to the next page (stays on the page grid)
             else:
                 all_ohlcv.extend(ohlcv)
                 since = ohlcv[-1][0] + 1  # Move to the next timestamp
-                time.sleep(1)  # Avoid hitting rate limits
-        return all_ohlcv
+        # drop the candles before the requested start that come with the aligned first page
+        return [candle for candle in all_ohlcv if candle[0] >= self.first_retrieval_date]
 
 
     def basic_prep_ohlcv_df(self, fetched_ohlcv, coin_name, agg_level = ['coin', 'weekday', 'day']):
         df = pd.DataFrame(fetched_ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
+        # 32 bit columns halve the memory of all following steps
+        df[PRICE_COLUMNS] = df[PRICE_COLUMNS].astype(np.float32)
         df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
         df['coin'] = coin_name
-        df['weekday'] = df['timestamp'].dt.weekday
+        df['weekday'] = df['timestamp'].dt.weekday.astype(np.int16)
         df['day'] = df['timestamp'].dt.date
-        df['hour'] = df['timestamp'].dt.hour
+        df['hour'] = df['timestamp'].dt.hour.astype(np.int16)
 
+        # volume weighted prices per group: factorize the group keys once and sum with np.bincount
+        codes, keys = pd.MultiIndex.from_frame(df[agg_level]).factorize(sort=True)
+        volume = df['volume'].to_numpy(dtype=float)
+        volume_sum = np.bincount(codes, weights=np.nan_to_num(volume), minlength=len(keys))
+        df_agg = keys.to_frame(index=False, name=agg_level).astype(df[agg_level].dtypes.to_dict())
         for cc in ['open', 'high', 'low', 'close']:
-            df[cc] = df[cc] * df['volume']
-
-        df = df.groupby(agg_level, as_index = False)[['open', 'high', 'low', 'close', 'volume']].sum()
-
-        for cc in ['open', 'high', 'low', 'close']:
-            df[cc] = df[cc] / df['volume']
+            weighted_sum = np.bincount(codes, weights=np.nan_to_num(df[cc].to_numpy(dtype=float) * volume), minlength=len(keys))
+            with np.errstate(divide='ignore', invalid='ignore'):  # groups without volume give NaN
+                df_agg[cc] = weighted_sum / volume_sum
+        df_agg['volume'] = volume_sum
+        df = df_agg
 
         # Rename 'open' to 'price'
-        df['price'] = df[['open', 'close']].apply(lambda x: x.mean(), axis = 1)
+        df['price'] = (df['open'] + df['close']) * 0.5
 
         df['volume_usd'] = df['volume'] * df['price']
+
+        # sums above are taken in 64 bit, the results are stored in 32 bit
+        df = downcast_floats(df)
         
         return df
 
@@ -98,18 +229,31 @@ class CryptoPriceLoader:
         """
         df = self.basic_prep_ohlcv_df(fetched_ohlcv, coin_name, agg_level=agg_level)
         
-        # Calculate price developments
-        for hours in [1, 3, 6, 12, 18, 24, 48, 72, 168]:
-            df[f'change_{hours}h'] = df['price'].pct_change(periods=hours) * 100
-        # Calculate future price developments
-        for hours in [3, 6, 12, 24, 48, 72, 168]:
-            df[f'future_change_{hours}h'] = df['price'].shift(-hours).pct_change(periods=hours, fill_method=None) * 100
+        # Calculate price developments (all horizons at once on a matrix of shifted prices)
+        change_hours = [1, 3, 6, 12, 18, 24, 48, 72, 168]
+        price = df['price'].ffill().to_numpy(dtype=float)  # pct_change pads missing prices
+        past = np.full((price.size, len(change_hours)), np.nan)
+        for j, hours in enumerate(change_hours):
+            past[hours:, j] = price[:-hours]
+        changes = (price[:, None] / past - 1.0) * 100
+        for j, hours in enumerate(change_hours):
+            df[f'change_{hours}h'] = changes[:, j]
+        # Calculate future price developments (price in x hours relative to now, NaN for the first x hours as before)
+        future_hours = [3, 6, 12, 24, 48, 72, 168]
+        price = df['price'].to_numpy(dtype=float)
+        ahead = np.full((price.size, len(future_hours)), np.nan)
+        for j, hours in enumerate(future_hours):
+            ahead[hours:-hours, j] = price[2 * hours:]
+        future_changes = (ahead / price[:, None] - 1.0) * 100
+        for j, hours in enumerate(future_hours):
+            df[f'future_change_{hours}h'] = future_changes[:, j]
 
         # Calculate average volumes and volume volatility
-        for hours in [6, 12, 24, 48, 72, 168, 336]:
-            df[f'avg_volume_{hours}h'] = df['volume'].rolling(hours).mean()
-            df[f'volatility_volume_{hours}h'] = df['volume'].rolling(hours).std()
-            df[f'volatility_volume_{hours}h'] = df[f'volatility_volume_{hours}h'] / df[f'avg_volume_{hours}h']
+        volume_stats = rolling_mean_std(df['volume'], [6, 12, 24, 48, 72, 168, 336])
+        for hours, (avg, std) in volume_stats.items():
+            df[f'avg_volume_{hours}h'] = avg
+            with np.errstate(divide='ignore', invalid='ignore'):  # no volume in the window gives NaN
+                df[f'volatility_volume_{hours}h'] = std / avg
 
         df['avg_volume_level_24_336'] = df['avg_volume_24h'] / df['avg_volume_336h']
         df['avg_volume_level_12_336'] = df['avg_volume_12h'] / df['avg_volume_336h']
@@ -123,34 +267,53 @@ class CryptoPriceLoader:
                     [f'volatility_volume_{hours}h' for hours in [6, 12, 24, 48, 72, 168, 336]] +
                      [f'change_{hours}h' for hours in [1, 3, 6, 12, 18, 24, 48, 72, 168]] +
                      [f'future_change_{hours}h' for hours in [3, 6, 12, 24, 48, 72, 168]]]
-        return df_prep
+        return downcast_floats(df_prep)
+
+    async def _fetch_and_prep(self, sym, agg_level, prepare):
+        print(sym)
+        ohlcv_sym = await self.fetch_all_ohlcv(sym)
+        if prepare:
+            return self.prep_ohlcv_df(fetched_ohlcv=ohlcv_sym, coin_name=sym, agg_level=agg_level)
+        return self.basic_prep_ohlcv_df(fetched_ohlcv=ohlcv_sym, coin_name=sym, agg_level=agg_level)
 
-    def fetch_prepare_crypto_prices(self, agg_level = ['coin', 'weekday', 'day'], prepare=True):
+    async def fetch_prepare_crypto_prices(self, agg_level = ['coin', 'weekday', 'day'], prepare=True):
         """
-        Fetches and prepares the cryptocurrency price data for all symbols.
+        Fetches and prepares the cryptocurrency price data for all symbols concurrently.
 
         Returns:
             pandas.DataFrame: The prepared DataFrame containing the cryptocurrency price data.
         """
-        df_prep = pd.DataFrame()
-        for sym in self.symbols:
-            try:
-                print(sym)
-                ohlcv_sym = self.fetch_all_ohlcv(sym)
-                if prepare:
-                    df_sym = self.prep_ohlcv_df(fetched_ohlcv=ohlcv_sym, coin_name=sym, agg_level=agg_level)
-                else:
-                    df_sym = self.basic_prep_ohlcv_df(fetched_ohlcv=ohlcv_sym, coin_name=sym, agg_level=agg_level)
-                df_prep = pd.concat([df_prep, df_sym])
-            except Exception as e:
-                print(f'Error fetching {sym}: {e}')
+        tasks = [self._fetch_and_prep(sym, agg_level, prepare) for sym in self.symbols]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        frames = []
+        for sym, df_sym in zip(self.symbols, results):
+            if isinstance(df_sym, Exception):
+                print(f'Error fetching {sym}: {df_sym}')
+                continue
+            frames.append(df_sym)
+        df_prep = pd.concat(frames, ignore_index=True)
+        # categorical coin: groupby/merge work on integer codes instead of strings
+        df_prep['coin'] = pd.Categorical(df_prep['coin'], categories=self.symbols)
         
         df_prep['day'] = pd.to_datetime(df_prep['day'])
         return df_prep
 
+    def run(self, agg_level = ['coin', 'weekday', 'day'], prepare=True):
+        """
+        Runs fetch_prepare_crypto_prices() in a new event loop and closes the exchange afterwards (for scripts; in notebooks await it directly and close() at the end).
+
+        Returns:
+            pandas.DataFrame: The prepared DataFrame containing the cryptocurrency price data.
+        """
+        async def fetch_and_close():
+            async with self:
+                return await self.fetch_prepare_crypto_prices(agg_level=agg_level, prepare=prepare)
+        return asyncio.run(fetch_and_close())
+
 # Beispiel für die Verwendung der Klasse
 if __name__ == "__main__":
     symbols = ['BTC/EUR', 'ETH/EUR', 'SOL/EUR']
     loader = CryptoPriceLoader(symbols=symbols)
-    #df_prep = loader.fetch_prepare_crypto_prices()
+    #df_prep = loader.run()
     #print(df_prep.head())
@@ -1,77 +1,104 @@
 # 0 Packages
-import requests
+import asyncio
+import aiohttp
 from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
 import pandas as pd
+from functools import lru_cache
 
 from textblob import TextBlob
 import re
 import nltk
 from nltk.corpus import stopwords
 
+from a3_data_engineering import rolling_sum_by_group, sort_if_needed
+
 #nltk.download('stopwords')
-stop_words = set(stopwords.words('english'))
+stop_words = frozenset(stopwords.words('english'))
+punct_re = re.compile(r'[^\w\s]')
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+}
+
+@lru_cache(maxsize=100_000)
+def text_polarity(text):
+    # titles/abstracts repeat across pages and coins, so each unique text is only parsed once
+    return TextBlob(text).sentiment.polarity
 
 # 1 Class
 class CryptoNewsLoader:
     # Initialisierung
-    def __init__(self, cryptocurrencies = ['Bitcoin', 'Ether', 'Solana'], number_pages = 50):
+    def __init__(self, cryptocurrencies = ['Bitcoin', 'Ether', 'Solana'], number_pages = 50, max_concurrency = 8):
         self.cryptocurrencies = cryptocurrencies
         self.number_pages = number_pages
+        self.max_concurrency = max_concurrency
 
     # Hilfsfunktionen
-    def fetch_news(self, crypto_name):
+    async def fetch_page(self, session, sem, url):
+        # at most max_concurrency requests are in flight at the same time
+        async with sem:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                return await response.read()
+
+    def parse_page(self, content, crypto_name):
+        news = []
+        soup = BeautifulSoup(content, 'lxml')
+        articles = soup.select('div.search-result-loop__content')
+
+        for article in articles:
+            title_tag = article.select_one('a.search-result-loop__link')
+            title = title_tag.text.strip() if title_tag else 'No title'
+            link = title_tag['href'] if title_tag else 'No link'
+            abstract_tag = article.select_one('p')
+            abstract = abstract_tag.text.strip() if abstract_tag else 'No abstract'
+            published_time_tag = article.select_one('div.search-result-loop__date')
+            published_time = published_time_tag.text.strip() if published_time_tag else 'No date'
+
+            news.append({
+                'coin' : crypto_name,
+                'published_time': published_time,
+                'title': title,
+                'abstract': abstract
+            })
+
+        return news
+
+    def create_session(self):
+        # one keep-alive connection pool for all pages and cryptocurrencies
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        return aiohttp.ClientSession(headers=HEADERS, connector=connector)
+
+    async def fetch_news(self, crypto_name, session=None):
+        if session is None:
+            async with self.create_session() as session:
+                return await self.fetch_news(crypto_name, session)
+
         news = []
         base_url1 = "https://crypto.news/page/"
         base_url2 = f"/?s={crypto_name}"
+        urls = [base_url1 + str(page) + base_url2 for page in range(1, self.number_pages + 1)]
 
-        for page in range(1, self.number_pages + 1):
-            if page%10 == 1:
-                print(page)
-            url = base_url1 + str(page) + base_url2
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-            }
+        # fetch all pages concurrently
+        sem = asyncio.Semaphore(self.max_concurrency)
+        contents = await asyncio.gather(*[self.fetch_page(session, sem, url) for url in urls])
 
-            response = requests.get(url, headers=headers)
-            if response.status_code != 200:
+        # parse in worker threads to keep the event loop free
+        pages = await asyncio.gather(*[asyncio.to_thread(self.parse_page, content, crypto_name)
+                                       for content in contents if content is not None])
+
+        # keep the pages up to the first failed or empty page (same result as the former sequential loop)
+        pages = iter(pages)
+        for page, content in enumerate(contents, start=1):
+            if content is None:
                 print(f"Failed to retrieve news for {crypto_name} on page {page}")
                 break
-
-            soup = BeautifulSoup(response.content, 'html.parser')
-            articles = soup.find_all('div', class_='search-result-loop__content')
-
+            articles = next(pages)
             if not articles:
-                # No more articles found, stop the loop
+                # No more articles found
                 break
-
-            for article in articles:
-                title_tag = article.find('a', class_='search-result-loop__link')
-                title = title_tag.text.strip() if title_tag else 'No title'
-                link = title_tag['href'] if title_tag else 'No link'
-                abstract_tag = article.find('p')
-                abstract = abstract_tag.text.strip() if abstract_tag else 'No abstract'
-                published_time_tag = article.find('div', class_='search-result-loop__date')
-                published_time = published_time_tag.text.strip() if published_time_tag else 'No date'
-
-                # Convert time to readable format
-                try:
-                    published_datetime = datetime.strptime(published_time, "%B %d, %Y at %I:%M %p")
-                    # add 2 hours due to different news page timezone
-                    published_datetime = published_datetime + timedelta(hours=2)
-                    published_day = published_datetime.strftime("%Y-%m-%d")
-                    published_hour = published_datetime.hour
-                except ValueError:
-                    published_day = '-1'
-                    published_hour = -1
-
-                news.append({
-                    'coin' : crypto_name,
-                    'published_day': published_day,
-                    'published_hour': published_hour,
-                    'title': title,
-                    'abstract': abstract
-                })
+            news.extend(articles)
 
         return news
     
@@ -80,21 +107,37 @@ class CryptoNewsLoader:
             print(f"Title: {article['title']}")
             print(f"Link: {article['link']}")
             print(f"Abstract: {article['abstract']}")
-            print(f"Published Day: {article['published_day']}")
-            print(f"Published Hour: {article['published_hour']}")
+            print(f"Published: {article['published_time']}")
             print("\n")
 
+    def parse_published_time(self, df):
+        # convert the raw time strings in one go; unparseable dates become NaT and are dropped
+        published_datetime = pd.to_datetime(df['published_time'], format="%B %d, %Y at %I:%M %p", errors='coerce')
+        # add 2 hours due to different news page timezone
+        published_datetime = published_datetime + pd.Timedelta(hours=2)
+        df = df.loc[published_datetime.notna()].drop(columns='published_time')
+        published_datetime = published_datetime.loc[df.index]
+        df.insert(1, 'published_day', published_datetime.dt.strftime("%Y-%m-%d"))
+        df.insert(2, 'published_hour', published_datetime.dt.hour.astype('int64'))
+        return df
+
     def clean_text(self, text):
         text = text.lower()  # Convert to lowercase
-        text = re.sub(r'[^\w\s]', '', text)  # Remove punctuation
+        text = punct_re.sub('', text)  # Remove punctuation
         text = ' '.join([word for word in text.split() if word not in stop_words])  # Remove stop words
         return text
+
+    def clean_series(self, s):
+        # same as clean_text, but lowercasing and punctuation removal run vectorized over the whole column
+        s = s.str.lower()
+        s = s.str.replace(punct_re, '', regex=True)
+        return s.map(lambda t: ' '.join(w for w in t.split() if w not in stop_words))
     
     def calculate_sentiment(self, df):
-        df['cleaned_title'] = df['title'].apply(self.clean_text)
-        df['cleaned_abstract'] = df['abstract'].apply(self.clean_text)
-        df['title_sentiment'] = df['cleaned_title'].apply(lambda x: TextBlob(x).sentiment.polarity)
-        df['abstract_sentiment'] = df['cleaned_abstract'].apply(lambda x: TextBlob(x).sentiment.polarity)
+        df['cleaned_title'] = self.clean_series(df['title'])
+        df['cleaned_abstract'] = self.clean_series(df['abstract'])
+        df['title_sentiment'] = df['cleaned_title'].map(text_polarity)
+        df['abstract_sentiment'] = df['cleaned_abstract'].map(text_polarity)
         return df
     
     def enlarge_dataframe(self, df):
@@ -106,45 +149,45 @@ class CryptoNewsLoader:
         
         # Create a complete grid of all combinations of cryptocurrencies, dates, and hours
         grid = pd.MultiIndex.from_product(
-            [df['coin'].unique(), date_range, hours], 
+            [df['coin'].unique(), date_range.strftime('%Y-%m-%d'), hours], 
             names=['coin', 'published_day', 'published_hour']
-        ).to_frame(index=False)
-        grid['published_day'] = grid['published_day'].apply(lambda x: str(x.date()))
+        )
         
-        # Merge the grid with the original DataFrame
-        enlarged_df = pd.merge(grid, df, how='left', on=['coin', 'published_day', 'published_hour'])
+        # Align the original DataFrame to the grid (missing hours become NaN)
+        enlarged_df = df.set_index(['coin', 'published_day', 'published_hour']).reindex(grid).reset_index()
         
         return enlarged_df
     
     def rolling_count_sum(self, df, window_range = 12):
-        df = df.sort_values(by=['coin', 'published_day', 'published_hour'])
+        df = sort_if_needed(df, ['coin', 'published_day', 'published_hour'])
 
         # Create a rolling count for each cryptocurrency
         name_count = 'news_count_' + str(window_range)
         name_sent = 'news_sentiment_' + str(window_range)
-        df[name_count] = df.groupby('coin')['news_count'].rolling(window=window_range, min_periods=1).sum().reset_index(level=0, drop=True)
-        df[name_sent] = df.groupby('coin')['news_sentiment'].rolling(window=window_range, min_periods=1).sum().reset_index(level=0, drop=True)
+        df[name_count] = rolling_sum_by_group(df, 'news_count', col_group='coin', window_length=window_range)
+        df[name_sent] = rolling_sum_by_group(df, 'news_sentiment', col_group='coin', window_length=window_range)
 
         return df
     
     # Hauptfunktion
-    def prepare_crypto_news(self):
+    async def prepare_crypto_news(self):
         # fetch all news
         all_news = []
-        for crypto in self.cryptocurrencies:
-            print(f"Fetching news for {crypto}...")
-            news = self.fetch_news(crypto)
-            all_news.extend(news)
+        async with self.create_session() as session:
+            for crypto in self.cryptocurrencies:
+                print(f"Fetching news for {crypto}...")
+                news = await self.fetch_news(crypto, session)
+                all_news.extend(news)
 
         # create DataFrame
         df_all_news =  pd.DataFrame(all_news)
-        df_all_news = df_all_news.loc[df_all_news.published_hour > -1]
+        df_all_news = self.parse_published_time(df_all_news)
         df_all_news.drop_duplicates(inplace=True)
         
         # calculate sentiment
         df_all_news_sent = self.calculate_sentiment(df_all_news)
         # aggregate to ensure that no duplicates per hour
-        df_all_news_sent = df_all_news_sent.groupby(['coin', 'published_day', 'published_hour'], as_index = False)['abstract_sentiment'].agg(['count', 'sum'])
+        df_all_news_sent = df_all_news_sent.groupby(['coin', 'published_day', 'published_hour'], as_index = False, observed=True)['abstract_sentiment'].agg(['count', 'sum'])
         df_all_news_sent.rename(columns = {'count' : 'news_count', 'sum' : 'news_sentiment'}, inplace = True)
         df_all_news_sent['news_count'] = df_all_news_sent['news_count'].fillna(0)
         df_all_news_sent['news_sentiment'] = df_all_news_sent['news_sentiment'].fillna(0)
@@ -156,4 +199,7 @@ class CryptoNewsLoader:
         df_grid_news  = self.rolling_count_sum(df = df_grid_news, window_range=24)
 
         return df_grid_news
-        
\ No newline at end of file
+
+    def run(self):
+        # synchronous entry point for scripts; in notebooks await prepare_crypto_news() directly
+        return asyncio.run(self.prepare_crypto_news())
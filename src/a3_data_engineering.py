@@ -1,4 +1,6 @@
 import pandas as pd
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 import warnings
 # Suppress FutureWarning messages
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -10,15 +12,67 @@ def calculate_relative_price_to_btc(df):
     df['price_relative_to_btc'] = df['price'] / df['price_btc']
     return df
 
+def sort_if_needed(df, col_sort):
+    # sorts in place unless the rows are already in order (e.g. sorted by an earlier step of the pipeline)
+    if isinstance(col_sort, str):
+        is_sorted = df[col_sort].is_monotonic_increasing
+    else:
+        is_sorted = pd.MultiIndex.from_frame(df[col_sort]).is_monotonic_increasing
+    if not is_sorted:
+        df.sort_values(by = col_sort, inplace = True)
+    return df
+
+def rolling_sum_by_group(df, col, col_group = 'coin', window_length = 5):
+    # rolling sum (min_periods=1) per group in the current row order, computed as difference of cumulative sums
+    values = df[col].to_numpy(dtype=float)
+    codes = pd.factorize(df[col_group])[0]
+    # stable sort keeps the row order within each group
+    order = np.argsort(codes, kind='stable')
+    v = values[order]
+    c = codes[order]
+    valid = ~np.isnan(v)
+    csum = np.concatenate([[0.0], np.cumsum(np.where(valid, v, 0.0))])
+    ccount = np.concatenate([[0], np.cumsum(valid)])
+    # window start: window_length rows back, but not before the first row of the group
+    i = np.arange(len(v))
+    lo = np.maximum(i + 1 - window_length, np.searchsorted(c, c, side='left'))
+    count = ccount[i + 1] - ccount[lo]
+    # like rolling().sum(): NaN if the window has no values, rows without group are dropped
+    res = np.where((count > 0) & (c >= 0), csum[i + 1] - csum[lo], np.nan)
+    result = np.empty_like(res)
+    result[order] = res
+    return result
+
+def centered_rolling_by_group(df, col, col_group, window_length, agg):
+    # centered rolling max/min per group (like rolling(center=True, min_periods=window_length)) with scipy's O(n) filters, returned in row order
+    filter1d, fill = {'max': (maximum_filter1d, -np.inf), 'min': (minimum_filter1d, np.inf)}[agg]
+    values = df[col].to_numpy(dtype=float)
+    codes = pd.factorize(df[col_group])[0]
+    result = np.full(values.size, np.nan)
+    # rows of each group in the current row order
+    order = np.argsort(codes, kind='stable')
+    for rows in np.split(order, np.flatnonzero(np.diff(codes[order])) + 1):
+        if rows.size < window_length or codes[rows[0]] < 0:
+            continue
+        v = values[rows]
+        is_nan = np.isnan(v)
+        rolled = filter1d(np.where(is_nan, fill, v), size=window_length)
+        # incomplete windows at the edges and windows containing NaN stay NaN
+        rolled[maximum_filter1d(is_nan, size=window_length)] = np.nan
+        rolled[:window_length // 2] = np.nan
+        rolled[rows.size - (window_length - 1) // 2:] = np.nan
+        result[rows] = rolled
+    return result
+
 def weighted_average(df, col_price, colname_new, window_length = 5,col_group = 'coin', col_sort = 'timestamp'):
     # weighted by volume
     df['weighted_price'] = df[col_price] * df['volume']
     # colname output
     colname_new = colname_new + str(window_length) 
     # calculation
-    df.sort_values(by = col_sort, inplace = True)
-    df['nominator'] = df.groupby(col_group)['weighted_price'].transform(lambda d: d.rolling(window=window_length, min_periods=1, center=False).sum())
-    df['denominator'] = df.groupby(col_group)['volume'].transform(lambda d: d.rolling(window=window_length, min_periods=1, center=False).sum())
+    sort_if_needed(df, col_sort)
+    df['nominator'] = rolling_sum_by_group(df, 'weighted_price', col_group=col_group, window_length=window_length)
+    df['denominator'] = rolling_sum_by_group(df, 'volume', col_group=col_group, window_length=window_length)
     df[colname_new] = df['nominator'] / df['denominator']
     # drop the weighted price
     df.drop(columns = ['weighted_price','nominator','denominator'], inplace = True)
@@ -28,11 +82,13 @@ def define_local_min_max(df, col_price, col_group = 'coin', period_window_min_ma
     # Defining "local maxima/minima"
     col_max = 'local_max' + suffix
     col_min = 'local_min' + suffix
-    df.sort_values(by = col_sort, inplace = True)
-    df[col_max] = df.groupby(col_group)[col_price].transform(lambda d: d.rolling(window=period_window_min_max, min_periods=period_window_min_max, center=True).max())
-    df[col_max] = df[[col_price, col_max]].apply(lambda x: 1* (x[0] == x[1]), axis=1)
-    df[col_min] = df.groupby(col_group)['avg_price_5'].transform(lambda d: d.rolling(window=period_window_min_max, min_periods=period_window_min_max, center=True).min())
-    df[col_min] = df[[col_price, col_min]].apply(lambda x: 1* (x[0] == x[1]), axis=1)
+    sort_if_needed(df, col_sort)
+    price = df[col_price].to_numpy(dtype=float)
+    rolling_max = centered_rolling_by_group(df, col_price, col_group, period_window_min_max, 'max')
+    # NaN at the edges (incomplete window) never equals the price, so these rows get 0
+    df[col_max] = (price == rolling_max).view(np.int8)
+    rolling_min = centered_rolling_by_group(df, 'avg_price_5', col_group, period_window_min_max, 'min')
+    df[col_min] = (price == rolling_min).view(np.int8)
     
     return df
 
@@ -40,16 +96,17 @@ def define_local_min_max2(df, col_price_min = 'low', col_price_max = 'high', col
     # Defining "local maxima/minima"
     col_max = 'local_max' + suffix
     col_min = 'local_min' + suffix
-    df.sort_values(by = col_sort, inplace = True)
-    df[col_max] = df.groupby(col_group)[col_price_max].transform(lambda d: d.rolling(window=period_window_min_max, min_periods=period_window_min_max, center=True).max())
-    df[col_max] = df[[col_price_max, col_max]].apply(lambda x: 1* (x[0] == x[1]), axis=1)
-    df[col_min] = df.groupby(col_group)[col_price_min].transform(lambda d: d.rolling(window=period_window_min_max, min_periods=period_window_min_max, center=True).min())
-    df[col_min] = df[[col_price_min, col_min]].apply(lambda x: 1* (x[0] == x[1]), axis=1)
+    sort_if_needed(df, col_sort)
+    rolling_max = centered_rolling_by_group(df, col_price_max, col_group, period_window_min_max, 'max')
+    # NaN at the edges (incomplete window) never equals the price, so these rows get 0
+    df[col_max] = (df[col_price_max].to_numpy(dtype=float) == rolling_max).view(np.int8)
+    rolling_min = centered_rolling_by_group(df, col_price_min, col_group, period_window_min_max, 'min')
+    df[col_min] = (df[col_price_min].to_numpy(dtype=float) == rolling_min).view(np.int8)
     
     return df
 
 def aggregate_support_levels(df, col_min, col_max, col_price, col_group, thres = 0.025, suffix = ''):
-    df_cluster = pd.DataFrame()
+    frames = []
     # define column names for each cluster (level: 1,2,3,...), the price of the min/max, and the number of hits to that min/max
     col_cluster = 'level' + suffix
     col_cluster_price = 'price_level' + suffix
@@ -60,26 +117,23 @@ def aggregate_support_levels(df, col_min, col_max, col_price, col_group, thres =
     for g in df_locals[col_group].unique():
         # we iterate through local min/max by price and then define clusters of similar prices to define support/resistance levels
         df_g = df_locals.loc[df_locals[col_group] == g].sort_values(col_price).reset_index(drop = True)
-        # initialize each row as an individual cluster
-        df_g[col_cluster] = range(1, df_g.shape[0]+1)
-        # iterate through the rows to define the clusters
-        for i in range(df_g.shape[0]-1):
-            v_i = df_g.iloc[i][col_price]
-            v_i2 = df_g.iloc[i+1][col_price]
-            if abs(v_i-v_i2) / v_i <= thres:
-                df_g.loc[i+1, col_cluster] = df_g.loc[i, col_cluster]
-        df_g[col_cluster_price] = df_g.groupby([col_cluster])[col_price].transform(lambda x: x.median())
-        df_g[col_cluster_counter] = df_g.groupby([col_cluster])[col_price].transform(lambda x: x.count())
-        df_cluster = pd.concat([df_cluster, df_g])
-        df_cluster = df_cluster[['day', col_group, col_cluster, col_cluster_price, col_cluster_counter]]
+        # a new cluster starts wherever the relative gap to the previous price exceeds thres
+        p = df_g[col_price].to_numpy(dtype=float)
+        new_cluster = np.concatenate([[True], ~(np.abs(np.diff(p)) / p[:-1] <= thres)])
+        # each cluster is numbered by the (1-based) position of its first row
+        df_g[col_cluster] = np.maximum.accumulate(np.where(new_cluster, np.arange(1, p.size + 1), 0))
+        df_g[col_cluster_price] = df_g.groupby([col_cluster], sort=False)[col_price].transform('median')
+        df_g[col_cluster_counter] = df_g.groupby([col_cluster], sort=False)[col_price].transform('count')
+        frames.append(df_g)
+    df_cluster = pd.concat(frames, ignore_index=True)[['day', col_group, col_cluster, col_cluster_price, col_cluster_counter]]
     df_result = df.merge(df_cluster, on = ['day', col_group], how = 'left')
     return df_result
 
 def calculate_momentum(df, col_new, col_price1, col_price2, col_price3, col_price4):
     
-    df['momentum_1_2'] = df[[col_price1, col_price2]].apply(lambda x: (x[0] - x[1]) / x[1], axis=1)
-    df['momentum_2_3'] = df[[col_price2, col_price3]].apply(lambda x: (x[0] - x[1]) / x[1], axis=1)
-    df['momentum_3_4'] = df[[col_price3, col_price4]].apply(lambda x: (x[0] - x[1]) / x[1], axis=1)
+    df['momentum_1_2'] = (df[col_price1] - df[col_price2]) / df[col_price2]
+    df['momentum_2_3'] = (df[col_price2] - df[col_price3]) / df[col_price3]
+    df['momentum_3_4'] = (df[col_price3] - df[col_price4]) / df[col_price4]
     
     cols_momentum = ['momentum_1_2', 'momentum_2_3', 'momentum_3_4']
     df[col_new] = df[cols_momentum].sum(axis=1)
@@ -87,11 +141,29 @@ def calculate_momentum(df, col_new, col_price1, col_price2, col_price3, col_pric
     
     return df
 
-def find_level(row, df_levels, direction = 'below', n = 1, col_find = 'price_level'):
-        try:
-            if direction == 'below':
-                return df_levels.loc[(df_levels['price_level'] <= row['price']) & (df_levels['coin'] == row['coin'])].tail(n)[col_find].values[0]
-            elif direction == 'above':
-                return df_levels.loc[(df_levels['price_level'] >= row['price']) & (df_levels['coin'] == row['coin'])].head(n)[col_find].values[0]
-        except:
-            return row[col_find]
\ No newline at end of file
+def find_level(df, df_levels, direction = 'below', n = 1, col_find = 'price_level'):
+    # for every row of df: the n-th level below (or above) the price of the same coin, via binary search on the sorted levels
+    prices = df['price'].to_numpy(dtype=float)
+    coins = df['coin'].to_numpy()
+    # rows without a level keep their own value (as before)
+    result = df[col_find].to_numpy(dtype=float, copy=True) if col_find in df.columns else np.full(len(df), np.nan)
+    df_levels = df_levels.loc[df_levels['price_level'].notna()].sort_values(by = 'price_level', kind = 'stable')
+    for c, df_c in df_levels.groupby('coin', sort=False):
+        levels = df_c['price_level'].to_numpy(dtype=float)
+        values = df_c[col_find].to_numpy(dtype=float)
+        mask = (coins == c) & ~np.isnan(prices)
+        if direction == 'below':
+            # number of levels <= price; the n-th closest one, or the lowest if there are fewer than n
+            k = np.searchsorted(levels, prices[mask], side='right')
+            found = k > 0
+            idx = np.maximum(k - n, 0)
+        elif direction == 'above':
+            # first level >= price; the n-th closest one, or the highest if there are fewer than n
+            k = np.searchsorted(levels, prices[mask], side='left')
+            found = k < len(levels)
+            idx = np.minimum(k + n - 1, len(levels) - 1)
+        else:
+            raise ValueError(f"direction must be 'below' or 'above', got {direction!r}")
+        rows = np.flatnonzero(mask)[found]
+        result[rows] = values[idx[found]]
+    return result